@@ -1,12 +1,21 @@
 import numpy as np
+import math
 import random
-from typing import List, Dict, Tuple
+import copy
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
+from typing import List, Dict, Tuple, Union, Optional
+try:
+    import numba
+except ImportError:
+    numba = None # Fall back to the pure NumPy split search
 
 # Converts a string to a number
 def to_number(s:str) -> float:
     s = s.strip()
     if s == '' or s == '?':
-        return np.nan
+        return math.nan
     return float(s)
 
 # Returns true iff s represents a number
@@ -17,135 +26,680 @@ def is_number(s:str) -> bool:
         return False
     return True
 
-# Divides the data on a random attribute.
-# Returns the two halves, and information about how the data was split.
-def divide_data(data:List[List[str]], label_col:int) -> Tuple[List[List[str]],List[List[str]],int,str,bool]:
-    for attempt in range(min(6, len(data) - 1)): # Try a few times
-        row_index = random.randrange(len(data))
-        row = data[row_index]
-        col_index = random.randrange(len(row) - 1)
-        col_index += (1 if col_index >= label_col else 0)
-        value = row[col_index].strip()
-        a:List[List[str]] = []
-        b:List[List[str]] = []
-        _isnumber = False
-        if is_number(value):
-            _isnumber = True
-            val = to_number(value)
-            if np.isnan(val):
-                for i in range(len(data)):
-                    if np.isnan(to_number(data[i][col_index])):
-                        b.append(data[i])
+# Converts an array of stripped strings to numbers in one pass.
+# Raises ValueError if any of them is not a number.
+def parse_numbers(cells:np.ndarray) -> np.ndarray:
+    missing = (cells == '') | (cells == '?')
+    return np.where(missing, 'nan', cells).astype(np.float64)
+
+# Decides once for each column whether it is numerical.
+# Expects the values to be stripped already.
+# Returns that decision, and a matrix of the parsed values with NaN
+# wherever a value is missing or its column is categorical.
+def classify_columns(data:Union[List[List[str]],np.ndarray]) -> Tuple[np.ndarray, np.ndarray]:
+    cells = np.asarray(data, dtype=str)
+    col_is_numeric = np.zeros(cells.shape[1], dtype=bool)
+    num_matrix = np.full(cells.shape, np.nan)
+    for col in range(cells.shape[1]):
+        try:
+            num_matrix[:, col] = parse_numbers(cells[:, col])
+            col_is_numeric[col] = True
+        except ValueError:
+            pass
+    return col_is_numeric, num_matrix
+
+# Holds a dataset that has been parsed once up front, so the trees can
+# refer to rows by index instead of copying and re-parsing the strings.
+# Every column is also label-encoded: cat_codes[i, j] is the position of
+# row i's value in levels[j], the sorted distinct values of column j.
+class PreparedData():
+    def __init__(self, data:List[List[str]]) -> None:
+        cells = np.array([ [ cell.strip() for cell in row ] for row in data ], dtype=object)
+        self.col_is_numeric, self.num_matrix = classify_columns(cells)
+        self.cat_codes = np.empty(cells.shape, dtype=np.int32)
+        self.levels:List[np.ndarray] = []
+        self.level_codes:List[Dict[str,int]] = []
+        for col in range(cells.shape[1]):
+            levels, codes = np.unique(cells[:, col], return_inverse=True)
+            self.cat_codes[:, col] = codes
+            self.levels.append(levels)
+            self.level_codes.append({ level: code for code, level in enumerate(levels) })
+        self.level_counts = np.array([ len(levels) for levels in self.levels ], dtype=np.int64)
+
+# Computes statistics about the label of each row, for measuring how impure
+# a set of rows is. For numerical labels these are (known, y, y*y), which can
+# be summed over the rows. Categorical labels are just their codes, and
+# divide_data counts the classes in each node with np.bincount.
+def label_stats(prep:PreparedData, label_col:int) -> np.ndarray:
+    if prep.col_is_numeric[label_col]:
+        y = prep.num_matrix[:, label_col]
+        known = ~np.isnan(y)
+        y = np.where(known, y, 0.)
+        return np.stack([known.astype(np.float64), y, y * y], axis=1)
+    else:
+        return prep.cat_codes[:, label_col]
+
+# Computes the impurity of sets of rows from their label stats and row counts.
+# For numerical labels the stats are the summed (known, y, y*y), and this is
+# the sum of squared differences from the mean.
+# For categorical labels the stats are the sums of the squared class counts,
+# and this is the row count times the Gini impurity.
+def impurity(stats:np.ndarray, counts:Union[int,np.ndarray], numerical:bool) -> np.ndarray:
+    with np.errstate(divide='ignore', invalid='ignore'):
+        if numerical:
+            return np.where(stats[..., 0] > 0, stats[..., 2] - stats[..., 1] ** 2 / stats[..., 0], 0.)
+        else:
+            return np.where(counts > 0, counts - stats / counts, 0.)
+
+# Splits whose total impurity is within this fraction of the best one count as ties
+_TIE_TOLERANCE = 1e-9
+
+# Chooses among candidate splits: the lowest total impurity, with ties going
+# to the most even split, and after that to the first candidate.
+# balance holds the size of each split's smaller half.
+# Without this, rows that all have different labels would be split one row at a time.
+def _pick(scores:np.ndarray, balance:np.ndarray) -> int:
+    best = float(scores.min())
+    near = scores <= best + _TIE_TOLERANCE * max(1., abs(best))
+    return int(np.argmax(np.where(near, balance, -1)))
+
+# Picks q evenly-spaced entries out of the candidate positions in pos
+def _spread(pos:np.ndarray, q:int) -> np.ndarray:
+    if len(pos) <= q:
+        return pos
+    if q == 1:
+        return pos[:1]
+    return pos[(np.arange(q) * (len(pos) - 1)) // (q - 1)]
+
+# For categorical labels: starts with the rows whose label codes are in head
+# in the lower half and the rest in the upper half, then moves the rows whose
+# codes are in body into the lower half one at a time.
+# class_counts are the class counts of all the rows together.
+# Returns the sums of the squared class counts of each half after p of the
+# body rows have moved, for each p from 0 to len(body).
+def _prefix_square_sums(class_counts:np.ndarray, head:np.ndarray, body:np.ndarray) -> Tuple[np.ndarray,np.ndarray]:
+    head_counts = np.bincount(head, minlength=len(class_counts))
+    rest_counts = class_counts - head_counts
+    # How many earlier body rows have the same class as each body row
+    order = np.argsort(body, kind='stable')
+    sorted_body = body[order]
+    seen = np.empty(len(body), dtype=np.int64)
+    seen[order] = np.arange(len(body)) - np.searchsorted(sorted_body, sorted_body)
+    # Moving a row of class c changes the halves' squared counts by 2*count+1 and 1-2*count
+    lower = np.concatenate(([0], np.cumsum(2 * (head_counts[body] + seen) + 1))) + (head_counts ** 2).sum()
+    upper = (rest_counts ** 2).sum() - np.concatenate(([0], np.cumsum(2 * (rest_counts[body] - seen) - 1)))
+    return lower, upper
+
+# Finds the best way to split rows on a numerical column.
+# Values >= the threshold go one way, and smaller or missing values go the other.
+# A threshold of NaN splits the missing values from the rest.
+# Only about sqrt(n) evenly-spaced quantiles are tried as thresholds.
+# labels are the rows' label stats, or their label codes out of the classes
+# counted in class_counts.
+# Returns the total impurity of the halves, the threshold and the size of
+# the smaller half, or None if the column cannot split the rows.
+def best_numerical_split(vals:np.ndarray, labels:np.ndarray, class_counts:np.ndarray, numerical:bool) -> Optional[Tuple[float,float,int]]:
+    n = len(vals)
+    known = ~np.isnan(vals)
+    n_nan = n - int(known.sum())
+    order = np.argsort(vals[known], kind='stable')
+    v = vals[known][order]
+    pos = np.flatnonzero(v[1:] > v[:-1]) + 1 # Where each candidate upper half begins
+    if len(pos) > 0:
+        pos = _spread(pos, max(1, int(math.sqrt(len(v)))))
+    lower_n = pos + n_nan # The missing values go in the lower half
+    if numerical:
+        total = labels.sum(axis=0)
+        nan_stats = labels[~known].sum(axis=0)
+        nan_score = impurity(nan_stats, n_nan, numerical) + impurity(total - nan_stats, n - n_nan, numerical)
+        scores = np.empty(0)
+        if len(pos) > 0:
+            cum = np.cumsum(labels[known][order], axis=0)
+            lower = cum[pos - 1] + (total - cum[-1])
+            scores = impurity(lower, lower_n, numerical) + impurity(total - lower, n - lower_n, numerical)
+    else:
+        lower_sq, upper_sq = _prefix_square_sums(class_counts, labels[~known], labels[known][order])
+        nan_score = impurity(lower_sq[0], n_nan, numerical) + impurity(upper_sq[0], n - n_nan, numerical)
+        scores = impurity(lower_sq[pos], lower_n, numerical) + impurity(upper_sq[pos], n - lower_n, numerical)
+    thresholds = v[pos]
+    if n_nan > 0 and n_nan < n:
+        scores = np.concatenate(([nan_score], scores))
+        thresholds = np.concatenate(([math.nan], thresholds))
+        lower_n = np.concatenate(([n_nan], lower_n))
+    if len(scores) == 0:
+        return None
+    i = _pick(scores, np.minimum(lower_n, n - lower_n))
+    return float(scores[i]), float(thresholds[i]), int(min(lower_n[i], n - lower_n[i]))
+
+# Finds the best way to split rows on a categorical column,
+# by separating the rows with one value from all the rest.
+# codes are the rows' label-encoded values, out of level_count possible ones.
+# labels and class_counts are as for best_numerical_split.
+# Returns the total impurity of the halves, the value's code and the size of the smaller half.
+# (A value that no row has, or that every row has, scores the same as not splitting.)
+def best_categorical_split(codes:np.ndarray, level_count:int, labels:np.ndarray, class_counts:np.ndarray, numerical:bool) -> Tuple[float,int,int]:
+    n = len(codes)
+    level_n = np.bincount(codes, minlength=level_count)
+    if numerical:
+        total = labels.sum(axis=0)
+        level_stats = np.stack([ np.bincount(codes, weights=labels[:, j], minlength=level_count) for j in range(labels.shape[1]) ], axis=1)
+        scores = impurity(level_stats, level_n, numerical) + impurity(total - level_stats, n - level_n, numerical)
+    else:
+        # Count each (value, class) pair to get the squared class counts of the rows with each value
+        k = len(class_counts)
+        pairs, pair_n = np.unique(codes.astype(np.int64) * k + labels, return_counts=True)
+        lower_sq = np.bincount(pairs // k, weights=pair_n ** 2, minlength=level_count)
+        cross = np.bincount(codes, weights=class_counts[labels], minlength=level_count)
+        upper_sq = (class_counts ** 2).sum() - 2 * cross + lower_sq
+        scores = impurity(lower_sq, level_n, numerical) + impurity(upper_sq, n - level_n, numerical)
+    balance = np.minimum(level_n, n - level_n)
+    i = _pick(scores, balance)
+    return float(scores[i]), i, int(balance[i])
+
+# Finds the best split of the rows in idx on any of the candidate columns,
+# considering only splits whose total impurity is below limit.
+# node_stats are the label stats of those rows, for numerical labels.
+# For categorical labels, y holds the rows' label codes, renumbered so that
+# class_counts counts each class in the node.
+# Returns the column (-1 if there is no such split), the threshold or code
+# to split on, and the total impurity of the two halves.
+def _best_split_numpy(num_matrix:np.ndarray, cat_codes:np.ndarray, level_counts:np.ndarray, idx:np.ndarray, col_is_numeric:np.ndarray, candidate_cols:np.ndarray, node_stats:np.ndarray, y:np.ndarray, class_counts:np.ndarray, numerical:bool, limit:float) -> Tuple[int,float,float]:
+    labels = node_stats if numerical else y
+    cols:List[int] = []
+    splits:List[Tuple[float,float,int]] = []
+    for col in candidate_cols:
+        if col_is_numeric[col]:
+            split = best_numerical_split(num_matrix[idx, col], labels, class_counts, numerical)
+        else:
+            score, code, balance = best_categorical_split(cat_codes[idx, col], int(level_counts[col]), labels, class_counts, numerical)
+            split = (score, float(code), balance)
+        if split is not None and split[0] < limit:
+            cols.append(int(col))
+            splits.append(split)
+    if len(cols) == 0:
+        return -1, math.nan, limit
+    i = _pick(np.array([ split[0] for split in splits ]), np.array([ split[2] for split in splits ]))
+    return cols[i], splits[i][1], splits[i][0]
+
+if numba is not None:
+    # numba versions of impurity, _pick and _best_split_numpy.
+    # They follow the NumPy code step for step, so they choose the same splits.
+    @numba.njit(cache=True)
+    def _impurity_num(stats:np.ndarray) -> float:
+        return stats[2] - stats[1] ** 2 / stats[0] if stats[0] > 0 else 0.
+
+    @numba.njit(cache=True)
+    def _impurity_cat(square_sum:int, count:int) -> float:
+        return count - square_sum / count if count > 0 else 0.
+
+    @numba.njit(cache=True)
+    def _pick_numba(scores:np.ndarray, balance:np.ndarray) -> int:
+        best = scores.min()
+        bound = best + _TIE_TOLERANCE * max(1., abs(best))
+        choice = -1
+        for i in range(len(scores)):
+            if scores[i] <= bound and (choice < 0 or balance[i] > balance[choice]):
+                choice = i
+        return choice
+
+    # Not parallel=True: Forest already spreads trees over processes, and
+    # forking the pool after numba's thread pool has started can hang the parent.
+    @numba.njit(cache=True)
+    def _best_split_numba(num_matrix:np.ndarray, cat_codes:np.ndarray, level_counts:np.ndarray, idx:np.ndarray, col_is_numeric:np.ndarray, candidate_cols:np.ndarray, node_stats:np.ndarray, y:np.ndarray, class_counts:np.ndarray, numerical:bool, limit:float) -> Tuple[int,float,float]:
+        n = len(idx)
+        k = node_stats.shape[1] if numerical else len(class_counts)
+        total = node_stats.sum(axis=0)
+        total_sq = (class_counts ** 2).sum()
+        col_scores = np.full(len(candidate_cols), np.inf)
+        col_vals = np.full(len(candidate_cols), np.nan)
+        col_balance = np.zeros(len(candidate_cols), dtype=np.int64)
+        for c in range(len(candidate_cols)):
+            col = candidate_cols[c]
+            if col_is_numeric[col]:
+                vals = np.empty(n)
+                for i in range(n):
+                    vals[i] = num_matrix[idx[i], col]
+                known = ~np.isnan(vals)
+                n_known = int(known.sum())
+                n_nan = n - n_known
+                known_vals = vals[known]
+                order = np.argsort(known_vals, kind='mergesort')
+                v = known_vals[order]
+                pos_count = 0
+                pos = np.empty(max(0, n_known - 1), dtype=np.int64)
+                for i in range(1, n_known):
+                    if v[i] > v[i - 1]:
+                        pos[pos_count] = i
+                        pos_count += 1
+                q = max(1, int(math.sqrt(n_known)))
+                m = min(q, pos_count)
+                chosen = np.empty(m, dtype=np.int64)
+                for j in range(m):
+                    if pos_count <= q:
+                        chosen[j] = pos[j]
+                    elif q == 1:
+                        chosen[j] = pos[0]
                     else:
-                        a.append(data[i])
+                        chosen[j] = pos[(j * (pos_count - 1)) // (q - 1)]
+                scores = np.empty(m + 1)
+                thresholds = np.empty(m + 1)
+                lower_n = np.empty(m + 1, dtype=np.int64)
+                count = 0
+                if numerical:
+                    if n_nan > 0 and n_nan < n:
+                        nan_stats = node_stats[~known].sum(axis=0)
+                        scores[0] = _impurity_num(nan_stats) + _impurity_num(total - nan_stats)
+                        thresholds[0] = np.nan
+                        lower_n[0] = n_nan
+                        count = 1
+                    if m > 0:
+                        known_stats = node_stats[known]
+                        cum = np.empty((n_known, k))
+                        for i in range(n_known):
+                            cum[i] = known_stats[order[i]] if i == 0 else cum[i - 1] + known_stats[order[i]]
+                        missing = total - cum[n_known - 1]
+                        for j in range(m):
+                            p = chosen[j]
+                            lower = cum[p - 1] + missing
+                            scores[count] = _impurity_num(lower) + _impurity_num(total - lower)
+                            thresholds[count] = v[p]
+                            lower_n[count] = p + n_nan
+                            count += 1
+                else:
+                    # Squared class counts of each half as the known rows move into the lower half in order
+                    lower_counts = np.zeros(k, dtype=np.int64)
+                    for i in range(n):
+                        if not known[i]:
+                            lower_counts[y[i]] += 1
+                    upper_counts = class_counts - lower_counts
+                    lower_sq = np.empty(n_known + 1, dtype=np.int64)
+                    upper_sq = np.empty(n_known + 1, dtype=np.int64)
+                    lower_sq[0] = (lower_counts ** 2).sum()
+                    upper_sq[0] = (upper_counts ** 2).sum()
+                    known_y = y[known]
+                    for i in range(n_known):
+                        cls = known_y[order[i]]
+                        lower_sq[i + 1] = lower_sq[i] + 2 * lower_counts[cls] + 1
+                        upper_sq[i + 1] = upper_sq[i] - (2 * upper_counts[cls] - 1)
+                        lower_counts[cls] += 1
+                        upper_counts[cls] -= 1
+                    if n_nan > 0 and n_nan < n:
+                        scores[0] = _impurity_cat(lower_sq[0], n_nan) + _impurity_cat(upper_sq[0], n - n_nan)
+                        thresholds[0] = np.nan
+                        lower_n[0] = n_nan
+                        count = 1
+                    for j in range(m):
+                        p = chosen[j]
+                        scores[count] = _impurity_cat(lower_sq[p], p + n_nan) + _impurity_cat(upper_sq[p], n - p - n_nan)
+                        thresholds[count] = v[p]
+                        lower_n[count] = p + n_nan
+                        count += 1
+                if count > 0:
+                    balance = np.minimum(lower_n[:count], n - lower_n[:count])
+                    i = _pick_numba(scores[:count], balance)
+                    col_scores[c] = scores[i]
+                    col_vals[c] = thresholds[i]
+                    col_balance[c] = balance[i]
             else:
-                for i in range(len(data)):
-                    if to_number(data[i][col_index]) >= val:
-                        b.append(data[i])
-                    else:
-                        a.append(data[i])
-        else:
-            for i in range(len(data)):
-                if data[i][col_index].strip() == value:
-                    b.append(data[i])
+                level_count = level_counts[col]
+                level_n = np.zeros(level_count, dtype=np.int64)
+                for i in range(n):
+                    level_n[cat_codes[idx[i], col]] += 1
+                scores = np.empty(level_count)
+                if numerical:
+                    level_stats = np.zeros((level_count, k))
+                    for i in range(n):
+                        level_stats[cat_codes[idx[i], col]] += node_stats[i]
+                    for code in range(level_count):
+                        scores[code] = _impurity_num(level_stats[code]) + _impurity_num(total - level_stats[code])
                 else:
-                    a.append(data[i])
-        if len(a) == 0 or len(b) == 0:
-            continue
-        return a, b, col_index, value, _isnumber
-    raise ValueError('Failed to divide data')
+                    # Count each (value, class) pair to get the squared class counts of the rows with each value
+                    pairs = np.empty(n, dtype=np.int64)
+                    cross = np.zeros(level_count, dtype=np.int64)
+                    for i in range(n):
+                        code = cat_codes[idx[i], col]
+                        pairs[i] = code * k + y[i]
+                        cross[code] += class_counts[y[i]]
+                    pairs.sort()
+                    lower_sq = np.zeros(level_count, dtype=np.int64)
+                    start = 0
+                    for i in range(1, n + 1):
+                        if i == n or pairs[i] != pairs[start]:
+                            lower_sq[pairs[start] // k] += (i - start) ** 2
+                            start = i
+                    for code in range(level_count):
+                        scores[code] = _impurity_cat(lower_sq[code], level_n[code]) + _impurity_cat(total_sq - 2 * cross[code] + lower_sq[code], n - level_n[code])
+                balance = np.minimum(level_n, n - level_n)
+                i = _pick_numba(scores, balance)
+                col_scores[c] = scores[i]
+                col_vals[c] = i
+                col_balance[c] = balance[i]
+        kept = np.flatnonzero(col_scores < limit)
+        if len(kept) == 0:
+            return -1, np.nan, limit
+        i = kept[_pick_numba(col_scores[kept], col_balance[kept])]
+        return candidate_cols[i], col_vals[i], col_scores[i]
+
+    best_split = _best_split_numba
+else:
+    best_split = _best_split_numpy
+
+# Placeholders for the label arrays that best_split does not use
+_NO_STATS = np.empty((0, 3))
+_NO_CODES = np.empty(0, dtype=np.int64)
+
+# Divides the rows in idx on the attribute that best reduces label impurity.
+# About sqrt(attributes) attributes chosen with rng are considered, and the
+# rest only if none of those helps.
+# Returns the two halves, and information about how the data was split,
+# or None if the rows are already pure or no attribute reduces the impurity.
+# The split value is a threshold for numerical attributes, or a code for categorical ones.
+def divide_data(prep:PreparedData, stats:np.ndarray, idx:np.ndarray, label_col:int, rng:random.Random) -> Optional[Tuple[np.ndarray,np.ndarray,int,Union[float,int],bool]]:
+    numerical = bool(prep.col_is_numeric[label_col])
+    if numerical:
+        node_stats = stats[idx]
+        y = node_stats[node_stats[:, 0] > 0, 1]
+        if len(y) == 0 or y.min() == y.max():
+            return None
+        limit = float(impurity(node_stats.sum(axis=0), len(idx), numerical))
+        codes, class_counts = _NO_CODES, _NO_CODES
+    else:
+        # Renumber the classes present in the node, so its counts do not grow with the number of classes overall
+        _, codes = np.unique(stats[idx], return_inverse=True)
+        codes = codes.astype(np.int64)
+        class_counts = np.bincount(codes)
+        if len(class_counts) == 1:
+            return None
+        limit = float(impurity((class_counts ** 2).sum(), len(idx), numerical))
+        node_stats = _NO_STATS
+    limit *= 1. - 1e-9
+    cols = [ col for col in range(prep.num_matrix.shape[1]) if col != label_col ]
+    rng.shuffle(cols)
+    want = max(1, int(math.sqrt(len(cols))))
+    args = (prep.num_matrix, prep.cat_codes, prep.level_counts, idx, prep.col_is_numeric)
+    labels = (node_stats, codes, class_counts, numerical, limit)
+    col_index, val, _ = best_split(*args, np.array(cols[:want], dtype=np.int64), *labels)
+    if col_index < 0 and want < len(cols):
+        col_index, val, _ = best_split(*args, np.array(cols[want:], dtype=np.int64), *labels)
+    if col_index < 0:
+        return None
+    _isnumber = bool(prep.col_is_numeric[col_index])
+    if _isnumber:
+        col = prep.num_matrix[idx, col_index]
+        mask = np.isnan(col) if math.isnan(val) else col >= val
+    else:
+        mask = prep.cat_codes[idx, col_index] == int(val)
+    return idx[~mask], idx[mask], int(col_index), (val if _isnumber else int(val)), _isnumber
 
 # Returns the mean of numerical values,
 # or the most common categorical value.
-def summarize_labels(data:List[List[str]], label_col:int) -> str:
-    if len(data) == 1:
-        # print(f'rows={len(data)}')
-        # print(f'cols={len(data[0])}')
-        # print(f'label_col={label_col}')
-        return data[0][label_col]
-    numerical = True
-    for i in range(len(data)):
-        # print(f'cols_in_row_{i}={len(data[i])}, label_col={label_col}')
-        if not is_number(data[i][label_col]):
-            numerical = False
-            break
-    if numerical:
+def summarize_labels(prep:PreparedData, idx:np.ndarray, label_col:int) -> str:
+    levels = prep.levels[label_col]
+    if len(idx) == 1:
+        return levels[prep.cat_codes[idx[0], label_col]]
+    if prep.col_is_numeric[label_col]:
         # Compute the mean
-        sum = 0.
-        val_count = 0
-        for i in range(len(data)):
-            try:
-                val = to_number(data[i][label_col])
-                if not np.isnan(val):
-                    val_count += 1
-                    sum += val
-            except:
-                pass
-        return str(sum / val_count) if val_count > 0 else '?'
+        vals = prep.num_matrix[idx, label_col]
+        vals = vals[~np.isnan(vals)]
+        return str(float(vals.mean())) if len(vals) > 0 else '?'
     else:
         # Find the most common value
-        counts:Dict[str,int] = {}
-        for i in range(len(data)):
-            value = data[i][label_col].strip()
-            if value in counts:
-                counts[value] += 1
-            else:
-                counts[value] = 1
-        most = 0
-        for k in counts:
-            if counts[k] > most:
-                most = counts[k]
-                value = k
-        return value
+        counts = Counter(prep.cat_codes[idx, label_col].tolist())
+        return levels[counts.most_common(1)[0][0]]
 
 
 class Tree():
-    def __init__(self, data:List[List[str]], label_col:int) -> None:
-        assert len(data) > 0, "Expected at least one row of data"
-        assert label_col < len(data[0]), f"label_col={label_col} out of range for data with {len(data[0])} columns"
-        try:
-            a, b, col, val, _isnumber = divide_data(data, label_col)
-            self.a = Tree(a, label_col)
-            self.b = Tree(b, label_col)
-            self.col = col
-            self.val = val
-            self.is_num = _isnumber
-            self.label = None
-        except:
-            self.label = summarize_labels(data, label_col)
+    # A forest has many nodes, so skip the per-node __dict__
+    __slots__ = ('a', 'b', 'col', 'val', 'is_num', 'label', 'val_f', 'val_isnan', 'val_code')
 
-    def predict(self, features:List[str]) -> str:
-        if not (self.label is None):
-            return self.label
-        if self.is_num:
-            val = to_number(features[self.col])
-            if np.isnan(to_number(self.val)):
-                if np.isnan(val):
-                    return self.b.predict(features)
-                else:
-                    return self.a.predict(features)
+    def __init__(self) -> None:
+        self.a:Optional[Tree] = None
+        self.b:Optional[Tree] = None
+        self.label:Optional[str] = None
+
+    # Grows a tree over the rows in idx.
+    # Uses an explicit stack, so deep trees do not hit the recursion limit.
+    # All of the tree's randomness comes from rng.
+    @classmethod
+    def build(cls, prep:PreparedData, idx:np.ndarray, label_col:int, rng:Optional[random.Random]=None) -> 'Tree':
+        assert len(idx) > 0, "Expected at least one row of data"
+        assert label_col < prep.num_matrix.shape[1], f"label_col={label_col} out of range for data with {prep.num_matrix.shape[1]} columns"
+        stats = label_stats(prep, label_col)
+        if rng is None:
+            rng = random.Random()
+        root = cls()
+        stack = [(root, idx)]
+        while len(stack) > 0:
+            node, node_idx = stack.pop()
+            split = divide_data(prep, stats, node_idx, label_col, rng)
+            if split is None:
+                node.label = summarize_labels(prep, node_idx, label_col)
+                continue
+            a, b, col, val, _isnumber = split
+            node.a = cls()
+            node.b = cls()
+            node.col = col
+            node.is_num = _isnumber
+            if _isnumber:
+                node.val = val
+                node.val_f = float(val)
+                node.val_isnan = math.isnan(node.val_f)
             else:
-                if val >= to_number(self.val):
-                    return self.b.predict(features)
+                node.val_code = int(val)
+                node.val = prep.levels[col][node.val_code]
+            stack.append((node.b, b))
+            stack.append((node.a, a)) # Popped first, to grow in the same order as recursion would
+        return root
+
+    # nums holds the row's parsed numbers and codes its label-encoded values.
+    # Walks down with a loop, so deep trees do not hit the recursion limit.
+    def predict(self, nums:List[float], codes:List[int]) -> str:
+        node = self
+        while node.label is None:
+            if node.is_num:
+                val = nums[node.col]
+                if node.val_isnan:
+                    go_b = math.isnan(val)
                 else:
-                    return self.a.predict(features)
-        else:
-            if features[self.col].strip() == self.val:
-                return self.b.predict(features)
+                    go_b = val >= node.val_f
+            else:
+                go_b = codes[node.col] == node.val_code
+            node = node.b if go_b else node.a
+        return node.label
+
+    # Pickles the tree as a flat list of nodes instead of nested objects,
+    # so deep trees do not hit the recursion limit on the way back from the pool.
+    def __reduce__(self) -> Tuple[object, Tuple[List[tuple]]]:
+        order:List[Tree] = []
+        stack = [self]
+        while len(stack) > 0:
+            node = stack.pop()
+            order.append(node)
+            if node.a is not None:
+                stack.append(node.b)
+                stack.append(node.a)
+        pos = { id(node): i for i, node in enumerate(order) }
+        flat = []
+        for node in order:
+            children = (pos[id(node.a)], pos[id(node.b)]) if node.a is not None else (-1, -1)
+            flat.append(tuple(getattr(node, field, None) for field in _NODE_FIELDS) + children)
+        return (_unflatten_tree, (flat,))
+
+    # Predicts the rows in idx all at once, writing each row's label into out.
+    # num_X holds the parsed numbers and code_X the label-encoded values.
+    def predict_batch(self, num_X:np.ndarray, code_X:np.ndarray, out:np.ndarray, idx:np.ndarray) -> None:
+        stack = [(self, idx)]
+        while len(stack) > 0:
+            node, node_idx = stack.pop()
+            if not (node.label is None):
+                out[node_idx] = node.label
+                continue
+            if node.is_num:
+                col = num_X[node_idx, node.col]
+                mask = np.isnan(col) if node.val_isnan else col >= node.val_f
             else:
-                return self.a.predict(features)
+                mask = code_X[node_idx, node.col] == node.val_code
+            stack.append((node.b, node_idx[mask]))
+            stack.append((node.a, node_idx[~mask]))
+
+# The per-node fields that Tree.__reduce__ saves, apart from the children
+_NODE_FIELDS = ('col', 'val', 'is_num', 'label', 'val_f', 'val_isnan', 'val_code')
+
+# Rebuilds a tree from the flat list of nodes made by Tree.__reduce__
+def _unflatten_tree(flat:List[tuple]) -> Tree:
+    nodes = [ Tree() for _ in flat ]
+    for node, entry in zip(nodes, flat):
+        for field, value in zip(_NODE_FIELDS, entry):
+            if value is not None:
+                setattr(node, field, value)
+        a, b = entry[-2:]
+        if a >= 0:
+            node.a = nodes[a]
+            node.b = nodes[b]
+    return nodes[0]
+
+# The prepared data each worker process builds its trees from.
+# Its big arrays live in shared memory, so they are not copied to each worker.
+_worker_prep:Optional[PreparedData] = None
+_worker_shms:List[shared_memory.SharedMemory] = []
+
+# The PreparedData arrays that go through shared memory
+_SHARED_FIELDS = ('num_matrix', 'cat_codes')
+
+# Describes where to find each shared array: (block name, shape, dtype)
+SharedSpecs = Dict[str, Tuple[str, Tuple[int, ...], str]]
+
+# Copies the big arrays of prep into new shared memory blocks.
+# Returns a copy of prep without those arrays, a description of where
+# they went, and the blocks, which the caller must close and unlink.
+def _share(prep:PreparedData) -> Tuple[PreparedData, SharedSpecs, List[shared_memory.SharedMemory]]:
+    skeleton = copy.copy(prep)
+    skeleton.level_codes = [] # Only needed for predicting
+    specs:SharedSpecs = {}
+    shms:List[shared_memory.SharedMemory] = []
+    try:
+        for field in _SHARED_FIELDS:
+            arr = getattr(prep, field)
+            shm = shared_memory.SharedMemory(create=True, size=max(1, arr.nbytes))
+            shms.append(shm)
+            np.ndarray(arr.shape, dtype=arr.dtype, buffer=shm.buf)[:] = arr
+            specs[field] = (shm.name, arr.shape, arr.dtype.str)
+            setattr(skeleton, field, None)
+    except:
+        for shm in shms:
+            shm.close()
+            shm.unlink()
+        raise
+    return skeleton, specs, shms
+
+def _init_worker(prep:PreparedData, specs:Optional[SharedSpecs]=None) -> None:
+    global _worker_prep
+    _worker_prep = prep
+    if specs is not None:
+        for field, (name, shape, dtype) in specs.items():
+            shm = shared_memory.SharedMemory(name=name)
+            _worker_shms.append(shm) # Keeps the block mapped while the worker runs
+            arr:np.ndarray = np.ndarray(shape, dtype=np.dtype(dtype), buffer=shm.buf)
+            arr.flags.writeable = False
+            setattr(prep, field, arr)
+
+# Builds one tree in a worker process, with its own random number generator
+def _build_one(args:Tuple[int, random.Random]) -> Tree:
+    label_col, rng = args
+    assert _worker_prep is not None, "Expected _init_worker to have run first"
+    return Tree.build(_worker_prep, np.arange(_worker_prep.num_matrix.shape[0]), label_col, rng)
 
 class Forest():
-    def __init__(self, data:List[List[str]], label_col:int, size:int=30) -> None:
+    # If seed is None, one is drawn from the random module.
+    # If workers is 1, the trees are built in this process.
+    def __init__(self, data:List[List[str]], label_col:int, size:int=30, seed:Optional[int]=None, workers:Optional[int]=None) -> None:
         assert len(data) > 0, "Expected at least one row of data"
         assert label_col >= 0, "label_col={label_col} must not be negative"
         assert label_col < len(data[0]), f"label_col={label_col} out of range for data with {len(data[0])} columns"
-        self.trees = []
-        for i in range(size):
-            self.trees.append(Tree(data, label_col))
+        prep = PreparedData(data)
+        self.col_is_numeric = prep.col_is_numeric
+        self.levels = prep.levels
+        self.level_codes = prep.level_codes
+        self.label_col = label_col
+        self.label_is_numeric = bool(prep.col_is_numeric[label_col])
+        if seed is None:
+            seed = random.randrange(2 ** 32)
+        rngs = [ random.Random(seed + i) for i in range(size) ]
+        if workers == 1:
+            idx = np.arange(len(data))
+            self.trees = [ Tree.build(prep, idx, label_col, rng) for rng in rngs ]
+        else:
+            jobs = [ (label_col, rng) for rng in rngs ]
+            skeleton, specs, shms = _share(prep)
+            try:
+                with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker, initargs=(skeleton, specs)) as ex:
+                    self.trees = list(ex.map(_build_one, jobs))
+            finally:
+                for shm in shms:
+                    shm.close()
+                    shm.unlink()
 
     def predict(self, features:List[str]) -> str:
-        preds:List[List[str]] = []
-        for tree in self.trees:
-            preds.append([ tree.predict(features) ])
-        return summarize_labels(preds, 0)
+        nums, codes = self._encode(features)
+        preds = [ tree.predict(nums, codes) for tree in self.trees ]
+        if self.label_is_numeric:
+            # Average the trees, ignoring missing values
+            vals = [ val for val in map(to_number, preds) if not math.isnan(val) ]
+            return str(math.fsum(vals) / len(vals)) if len(vals) > 0 else '?'
+        else:
+            return Counter(preds).most_common(1)[0][0]
+
+    # Parses a row of features into numbers and label-encoded values, as Tree.predict expects.
+    # Values that were not seen in training get the code -1.
+    def _encode(self, features:List[str]) -> Tuple[List[float], List[int]]:
+        nums = [ math.nan ] * len(features)
+        codes = [ -1 ] * len(features)
+        for col, feature in enumerate(features):
+            if col == self.label_col:
+                continue
+            feature = feature.strip()
+            if self.col_is_numeric[col]:
+                nums[col] = to_number(feature)
+            else:
+                codes[col] = self.level_codes[col].get(feature, -1)
+        return nums, codes
+
+    # Predicts many rows at once.
+    # Returns the same labels as calling predict on each row.
+    def predict_batch(self, X:List[List[str]]) -> List[str]:
+        cells = np.char.strip(np.asarray(X, dtype=str))
+        num_X = np.full(cells.shape, np.nan)
+        code_X = np.full(cells.shape, -1, dtype=np.int32)
+        for col in range(cells.shape[1]):
+            if col == self.label_col:
+                continue
+            if self.col_is_numeric[col]:
+                num_X[:, col] = parse_numbers(cells[:, col])
+            else:
+                # Look the values up in the sorted levels, using -1 for unseen ones
+                levels = self.levels[col].astype(str)
+                pos = np.minimum(np.searchsorted(levels, cells[:, col]), len(levels) - 1)
+                code_X[:, col] = np.where(levels[pos] == cells[:, col], pos, -1)
+        n = cells.shape[0]
+        t = len(self.trees)
+        votes = np.empty((n, t), dtype=object)
+        for i, tree in enumerate(self.trees):
+            tree.predict_batch(num_X, code_X, votes[:, i], np.arange(n))
+        if self.label_is_numeric:
+            # Average the trees, ignoring missing values.
+            # math.fsum rounds the same way as in predict, whatever order the votes are in.
+            vals = parse_numbers(votes.astype(str))
+            known = ~np.isnan(vals)
+            counts = known.sum(axis=1)
+            return [ str(math.fsum(vals[i, known[i]]) / counts[i]) if counts[i] > 0 else '?' for i in range(n) ]
+        else:
+            # Take the most common vote, breaking ties by which tree voted for it first
+            levels, codes = np.unique(votes.astype(str), return_inverse=True)
+            codes = codes.reshape(n, t)
+            rows = np.repeat(np.arange(n), t)
+            counts = np.zeros((n, len(levels)), dtype=np.int64)
+            np.add.at(counts, (rows, codes.ravel()), 1)
+            first = np.full((n, len(levels)), t, dtype=np.int64)
+            np.minimum.at(first, (rows, codes.ravel()), np.tile(np.arange(t), n))
+            best = np.argmax(counts * (t + 1) - first, axis=1)
+            return levels[best].tolist()
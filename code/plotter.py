@@ -1,10 +1,11 @@
 from typing import Tuple, List, Union, Dict, cast
 import svgwrite
 import math
+import io
 import numpy as np
 import webbrowser
+import itertools
 import plotter
-import random
 
 # Rounds pos to the nearest integer multiple of step
 def snap(pos:float, step:float) -> float:
@@ -27,15 +28,17 @@ def find_tick_spacing(target_count:int, min_val:float, max_val:float) -> Tuple[f
 
 # finds min and max in a nan-tolerant way
 def get_min_and_max(vals:List[float]) -> Tuple[float, float]:
-    min_val = np.nan
-    max_val = np.nan
-    for val in vals:
-        if not np.isnan(val):
-            min_val = min(val, min_val)
-            max_val = max(val, max_val)
-    return (min_val, max_val)
+    a = np.asarray(vals, dtype=float)
+    a = a[~np.isnan(a)]
+    if len(a) == 0:
+        return (math.nan, math.nan)
+    return (float(a.min()), float(a.max()))
 
 
+# Numbers each Plotter, so the ids of their <defs> stay unique
+# even when several plots are written into one HTML page
+_plot_ids = itertools.count()
+
 # A class for making SVG plots
 class Plotter():
     def __init__(self, size:Tuple[int, int], bottom_left:Tuple[float, float], top_right:Tuple[float, float]) -> None:
@@ -43,13 +46,21 @@ class Plotter():
         self.size = size
         self.mins = bottom_left
         self.maxs = top_right
+        self._sx = self.size[0] / (self.maxs[0] - self.mins[0])
+        self._sy = self.size[1] / (self.maxs[1] - self.mins[1])
+        self._id = next(_plot_ids)
+        self._point_defs:Dict[Tuple[Tuple[int,int,int],float],str] = {}
 
     # Projects a point onto the graph
     def _proj(self, x: Tuple[float,float]) -> Tuple[float,float]:
-        return (
-            (x[0] - self.mins[0]) / (self.maxs[0] - self.mins[0]) * self.size[0],
-            self.size[1] - (x[1] - self.mins[1]) / (self.maxs[1] - self.mins[1]) * self.size[1],
-        )
+        return ((x[0] - self.mins[0]) * self._sx, self.size[1] - (x[1] - self.mins[1]) * self._sy)
+
+    # Projects an (N, 2) array of points onto the graph
+    def _proj_arr(self, pts:np.ndarray) -> np.ndarray:
+        out = np.empty(pts.shape)
+        out[:, 0] = (pts[:, 0] - self.mins[0]) * self._sx
+        out[:, 1] = self.size[1] - (pts[:, 1] - self.mins[1]) * self._sy
+        return out
 
     # Draw a line
     def line(self, a:Tuple[float,float], b:Tuple[float,float], thickness:float=1., color:Tuple[int,int,int]=(0,0,0), absolute:bool=False) -> None:
@@ -58,21 +69,36 @@ class Plotter():
             b = self._proj(b)
         self.d.add(self.d.line(a, b, stroke_width=thickness, stroke=svgwrite.rgb(*color)))
 
+    # Draw many line segments as a single path element
+    def lines(self, segments:List[Tuple[Tuple[float,float],Tuple[float,float]]], thickness:float=1., color:Tuple[int,int,int]=(0,0,0), absolute:bool=False) -> None:
+        if len(segments) == 0:
+            return
+        if not absolute:
+            segments = [ (self._proj(a), self._proj(b)) for a, b in segments ]
+        d = ' '.join([ f'M {a[0]} {a[1]} L {b[0]} {b[1]}' for a, b in segments ])
+        self.d.add(self.d.path(d=d, stroke_width=thickness, stroke=svgwrite.rgb(*color), fill='none'))
+
     # Draw an arrow
     def arrow(self, a:Tuple[float,float], b:Tuple[float,float], thickness:float=1., color:Tuple[int,int,int]=(0,0,0), head_size:float=10., head_angle:float=0.785398163, absolute:bool=False) -> None:
         angle = math.atan2(a[1] - b[1], a[0] - b[0])
         ang1 = angle + head_angle / 2.
         ang2 = angle - head_angle / 2.
-        self.line(a, b, thickness, color, absolute)
-        self.line(b, (b[0] + head_size * math.cos(ang1), b[1] + head_size * math.sin(ang1)), thickness, color, absolute)
-        self.line(b, (b[0] + head_size * math.cos(ang2), b[1] + head_size * math.sin(ang2)), thickness, color, absolute)
+        head1 = (b[0] + head_size * math.cos(ang1), b[1] + head_size * math.sin(ang1))
+        head2 = (b[0] + head_size * math.cos(ang2), b[1] + head_size * math.sin(ang2))
+        points = [a, b, head1, b, head2]
+        if not absolute:
+            points = [ self._proj(p) for p in points ]
+        self.d.add(self.d.polyline(points, stroke_width=thickness, stroke=svgwrite.rgb(*color), fill='none'))
 
     # Draw an empty rectangle
     def rect_empty(self, a:Tuple[float,float], b:Tuple[float,float], thickness:float=1., color:Tuple[int,int,int]=(0,0,0), absolute:bool=False) -> None:
-        self.line(a, (a[0], b[1]), thickness, color, absolute)
-        self.line((a[0], b[1]), b, thickness, color, absolute)
-        self.line(b, (b[0], a[1]), thickness, color, absolute)
-        self.line((b[0], a[1]), a, thickness, color, absolute)
+        if not absolute:
+            a = self._proj(a)
+            b = self._proj(b)
+        tl = (min(a[0], b[0]), min(a[1], b[1]))
+        br = (max(a[0], b[0]), max(a[1], b[1]))
+        wh = (br[0]-tl[0],br[1]-tl[1])
+        self.d.add(self.d.rect(tl, wh, stroke_width=thickness, stroke=svgwrite.rgb(*color), fill='none'))
 
     # Draw a filled rectangle
     def rect(self, a:Tuple[float,float], b:Tuple[float,float], color:Tuple[int,int,int]=(0,0,0), absolute:bool=False) -> None:
@@ -84,42 +110,56 @@ class Plotter():
         wh = (br[0]-tl[0],br[1]-tl[1])
         self.d.add(self.d.rect(tl, wh, stroke='none', fill=svgwrite.rgb(*color)))
 
+    # Returns the id of a circle of this color and radius in <defs>, adding it the first time
+    def point_marker(self, color:Tuple[int,int,int], radius:float) -> str:
+        key = (color, radius)
+        if not key in self._point_defs:
+            marker_id = f'plot{self._id}pt{len(self._point_defs)}'
+            self.d.defs.add(self.d.circle((0, 0), r=radius, fill=svgwrite.rgb(*color), id=marker_id))
+            self._point_defs[key] = marker_id
+        return self._point_defs[key]
+
     # Draw a circle
+    # Each one is a <use> of a shared marker, so the style is only written once
     def circle(self, pos:Tuple[float,float], radius:float=1., color:Tuple[int,int,int]=(0,0,0), absolute:bool=False) -> None:
         if not absolute:
             pos = self._proj(pos)
-        self.d.add(self.d.circle(pos, r=radius, fill=svgwrite.rgb(*color)))
+        self.d.add(self.d.use(f'#{self.point_marker(color, radius)}', insert=pos))
 
     # Draw text
     def text(self, s:str, pos:Tuple[float,float], size:float=16, color:Tuple[int,int,int]=(0,0,0), absolute:bool=False) -> None:
         if not absolute:
             pos = self._proj(pos)
-        if not np.isnan(pos[0]) and not np.isnan(pos[1]):
+        if not math.isnan(pos[0]) and not math.isnan(pos[1]):
             self.d.add(self.d.text(s, insert=pos, fill=svgwrite.rgb(*color), style=f'font-size:{size}px; font-family:Arial'))
 
     # Draw vertical grid lines
     # If label_size is 0, no labels will be drawn
     def vert_lines(self, target_count:int=20, thickness:float=.1, color:Tuple[int,int,int]=(128,128,128), label_size:int=8) -> None:
         pos, step = find_tick_spacing(target_count, self.mins[0], self.maxs[0])
+        segments = []
         while pos <= self.maxs[0]:
             pos = snap(pos, step)
-            self.line((pos, self.mins[1]), (pos, self.maxs[1]), thickness, color)
+            segments.append(((pos, self.mins[1]), (pos, self.maxs[1])))
             if label_size > 0:
                 vpos = 0 if 0 >= self.mins[1] and 0 <= self.maxs[1] else self.mins[1]
                 self.text(f'{pos:.6}', (pos, vpos), size=label_size, color=color)
             pos += step
+        self.lines(segments, thickness, color)
 
     # Draw horizontal grid lines
     # If label_size is 0, no labels will be drawn
     def horiz_lines(self, target_count:int=20, thickness:float=.1, color:Tuple[int,int,int]=(128,128,128), label_size:int=8) -> None:
         pos, step = find_tick_spacing(target_count, self.mins[1], self.maxs[1])
+        segments = []
         while pos <= self.maxs[1]:
             pos = snap(pos, step)
-            self.line((self.mins[0], pos), (self.maxs[0], pos), thickness, color)
+            segments.append(((self.mins[0], pos), (self.maxs[0], pos)))
             if label_size > 0:
                 hpos = 0 if 0 >= self.mins[0] and 0 <= self.maxs[0] else self.mins[0]
                 self.text(f'{pos:.6}', (hpos, pos), size=label_size, color=color)
             pos += step
+        self.lines(segments, thickness, color)
 
     # Draw a grid
     # If label_size is 0, no labels will be drawn
@@ -129,12 +169,15 @@ class Plotter():
 
     # Converts to a string in SVG format
     def tostr(self) -> str:
-        return '<?xml version="1.0" encoding="utf-8" ?>\n' + str(self.d.tostring())
+        buf = io.StringIO()
+        self.d.write(buf)
+        return buf.getvalue()
 
     # Generates an SVG file
+    # (svgwrite's Drawing.write emits the XML declaration itself.)
     def tosvg(self, filename:str) -> None:
-        with open(filename, 'w') as f:
-            f.write(self.tostr())
+        with open(filename, 'w', encoding='utf-8') as f:
+            self.d.write(f)
 
 
 # Makes a histogram plot
@@ -143,10 +186,9 @@ def plot_histogram(vals:List[float]) -> Plotter:
     min_val, max_val = get_min_and_max(vals)
     buckets = max(2, int(1.2 * math.sqrt(len(vals))))
     bucket_width = (max_val - min_val) / buckets
-    counts = [0] * buckets
-    for v in vals:
-        bucket = max(0, min(buckets - 1, int((v - min_val) // bucket_width)))
-        counts[bucket] += 1
+    a = np.asarray(vals, dtype=float)
+    hist, _ = np.histogram(a[~np.isnan(a)], bins=buckets, range=(min_val, max_val))
+    counts = hist.tolist()
     biggest = max(counts)
 
     # Plot the histogram
@@ -190,9 +232,11 @@ def plot_float_float_pairs(pairs:List[Tuple[float,float]]) -> Plotter:
     radius = 30. / math.sqrt(len(pairs))
     jitter_x = 0.02 * (plotter.maxs[0] - plotter.mins[0])
     jitter_y = 0.02 * (plotter.maxs[1] - plotter.mins[1])
-    for i in range(len(pairs)):
-        p = pairs[i]
-        plotter.circle((p[0] + random.gauss(0., jitter_x), p[1] + random.gauss(0., jitter_y)), radius, (0,0,128))
+    # Jitter and project all the points at once
+    pts = np.asarray(pairs, dtype=float)
+    projected = plotter._proj_arr(pts + np.random.normal(0., [jitter_x, jitter_y], pts.shape))
+    for x, y in projected.tolist():
+        plotter.circle((x, y), radius, (0,0,128), absolute=True)
     return plotter
 
 def plot_float_str_pairs(pairs:List[Tuple[float,str]]) -> Plotter: